@@ -1,12 +1,18 @@
 from __future__ import annotations
 
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, UploadFile, File, HTTPException
+from fastapi.concurrency import run_in_threadpool
 from pathlib import Path
-import pdfplumber, uuid, json
+import anyio.to_thread
+import os, shutil, sys, uuid
+import numpy as np
 from pydantic import BaseModel
 
+from backend.rag.chunk_store import ChunkColumns, save_chunks
+from backend.rag.extraction import extract_page_texts, shutdown_pool
 from backend.rag.indexing import build_index_for_doc
-from backend.rag.retrieval import search_doc
+from backend.rag.retrieval import query_batcher, doc_registry
 from typing import List, Optional, Dict, Any
 from backend.rag.answering import answer_with_citations
 
@@ -14,13 +20,24 @@ from backend.rag.answering import answer_with_citations
 
 
 
-app = FastAPI()
+#raises the worker thread limit so blocking work (pdf parsing, embedding, search) from concurrent requests can overlap
+#and stops the shared pdf extraction pool on shutdown
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    limiter = anyio.to_thread.current_default_thread_limiter()
+    limiter.total_tokens = max(limiter.total_tokens, (os.cpu_count() or 1) * 4) #never below anyio's default (40)
+    yield
+    shutdown_pool()
+
+
+app = FastAPI(lifespan=lifespan)
 UPLOAD_DIR = Path("data/uploads") #directory to save the uploaded files
 UPLOAD_DIR.mkdir(parents=True, exist_ok=True)#ensure the upload directory exists
 INDEX_DIR = Path("data/index")
 INDEX_DIR.mkdir(parents=True, exist_ok=True)#ensure the index directory exists
 CHUNK_SIZE = 1200
 OVERLAP = 200
+COPY_BUFSIZE = 4 * 1024 * 1024 #4 MB per copy call when saving uploads
 
 
 def chunk_text(text, chunk_size, overlap):
@@ -29,116 +46,151 @@ def chunk_text(text, chunk_size, overlap):
     if overlap < 0 or overlap >= chunk_size:
         raise ValueError("overlap must be >= 0 and < chunk_size")
     
-    chunks = []
-    start = 0
     stride = chunk_size - overlap
-    while start < len(text):
-        end = start + chunk_size
-        chunk = text[start:end]
-        chunks.append(chunk)
-        start += stride
-    
-    return chunks
-    
-
-@app.post("/upload")
-async def upload_pdf(file: UploadFile = File(...)):
-    #if the file has no name
-    if not file.filename:
-        raise HTTPException(status_code=400, detail ="Missing filename")
-    #if the file type is not a pdf
-    if file.content_type not in ("application/pdf", "application/x-pdf"):
-        raise HTTPException(status_code=415, detail=f"Unsupported content type: {file.content_type}")
+    #precomputes every window start so slicing happens in one list comprehension
+    return [text[start:start + chunk_size] for start in range(0, len(text), stride)]
+
+
+#copies the already-received upload to disk and returns the number of bytes written
+#on Linux, if the spooled upload has rolled over to a real file, os.sendfile copies it inside the kernel (zero-copy)
+#otherwise (other platforms, in-memory spool, or sendfile failing) it falls back to a buffered copy
+def _save_upload(src, save_path: Path) -> int:
+    src.seek(0) #rewind in case anything already read from it
+    with open(save_path, "wb") as out:
+        # sendfile(2) only accepts a regular file as the destination on Linux (macOS/BSD need a socket), same check shutil uses
+        # _rolled is checked before fileno() because fileno() on a SpooledTemporaryFile forces an in-memory spool to disk
+        if sys.platform.startswith("linux") and getattr(src, "_rolled", True):
+            try:
+                in_fd = src.fileno()
+            except (AttributeError, OSError, ValueError):
+                in_fd = None
+            if in_fd is not None:
+                offset = 0
+                try:
+                    while True:
+                        sent = os.sendfile(out.fileno(), in_fd, offset, COPY_BUFSIZE)
+                        if sent == 0: #end of file
+                            break
+                        offset += sent
+                    return offset
+                except OSError: #e.g. a filesystem without sendfile support, redo the copy the buffered way
+                    out.seek(0)
+                    out.truncate()
+                    src.seek(0)
+        shutil.copyfileobj(src, out, COPY_BUFSIZE)
+        return out.tell()
     
-    #unique identifier for the document
-    doc_id = str(uuid.uuid4())
-    save_path = UPLOAD_DIR / f"{doc_id}.pdf" #path to save the file
 
-    #writes the file to disk in chunks
-    bytes_saved = 0 #tracks how many bytes have been saved
-    with open(save_path, "wb") as out: #opens the file at the path in write-binary mode and name it out
-        #reads the file in chunks until there is no more data
-        while True:
-            buf = await file.read(1024 * 1024)  # (CHANGED variable name) Read in 1 MB chunks
-            if not buf: #if no more data is left
-                break
-            out.write(buf) #writes the chunk to the file
-            bytes_saved += len(buf) #updates the byte counter
-    
-
-    page_texts = [] #list to hold the text from each page
-    chunks = [] #list to hold the text chunks
-    chunk_id = 0 #unique identifier for each chunk
+#first n characters of the pages joined by "\n", only joining as many pages as needed
+def _first_n_chars(page_texts: list[str], n: int) -> str:
+    parts = []
+    total = -1 #length of "\n".join(parts), the first page has no separator
+    for text in page_texts:
+        parts.append(text)
+        total += len(text) + 1 #+1 for the "\n" separator
+        if total >= n:
+            break
+    return "\n".join(parts)[:n]
+
+
+#opens the saved pdf, extracts and chunks every page, and writes the chunk columns
+#this is all blocking CPU/disk work, so the upload endpoint runs it in a worker thread
+#returns (pages, chars_extracted, preview, total_chunks)
+def _process_pdf(save_path: Path, doc_id: str) -> tuple[int, int, str, int]:
+    # chunks are kept as parallel columns (row i of each list is chunk i)
+    chunk_ids = [] #unique identifier for each chunk
+    page_nums = [] #page each chunk came from
+    text_chunks = [] #the chunk texts
+    chunk_id = 0 #next chunk identifier
     
     try:
-        with pdfplumber.open(save_path) as pdf: #opens the saved pdf file
-            pages = len(pdf.pages) #number of pages in the pdf
-            page_number = 1
-            for page in pdf.pages:
-                text = page.extract_text()
-                if not text: #if there is no text on the page
-                    text = ""
-                page_texts.append(text) #adds the text to the list
-                for chunk in chunk_text(text, CHUNK_SIZE, OVERLAP): #for each chunk on the page
-
-                    # This improves retrieval quality and reduces wasted vectors.
-                    if len(chunk.strip()) < 30:
-                        continue
-
-                    chunk_uid = f"{doc_id}_{chunk_id:05d}" #unique identifier for the chunk
-
-                    chunks.append({
-                        "doc_id": doc_id,
-                        "chunk_id": chunk_id,
-                        "chunk_uid": chunk_uid,   # (ADDED - Phase 3)
-                        "page_number": page_number,
-                        "text": chunk
-                    })
-                    chunk_id += 1
-                page_number += 1 #increment the page number
+        page_texts = extract_page_texts(save_path) #the text from each page (large pdfs are split across processes)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"PDF processing failed: {e}")
+    pages = len(page_texts) #number of pages in the pdf
+
+    for page_number, text in enumerate(page_texts, start=1):
+        for chunk in chunk_text(text, CHUNK_SIZE, OVERLAP): #for each chunk on the page
+
+            # This improves retrieval quality and reduces wasted vectors.
+            if len(chunk.strip()) < 30:
+                continue
 
-    full_text = "\n".join(page_texts) #joins all the text parts into a single string
-    chars_extracted = len(full_text)
-    preview = full_text[:500]  # First 500 characters as preview
+            chunk_ids.append(chunk_id)
+            page_nums.append(page_number)
+            text_chunks.append(chunk)
+            chunk_id += 1
+
+    # same values as on the "\n"-joined text of every page, without building that string
+    chars_extracted = sum(map(len, page_texts)) + max(pages - 1, 0)
+    preview = _first_n_chars(page_texts, 500)  # First 500 characters as preview
 
 
     doc_index_dir = INDEX_DIR / doc_id #directory to save the index for this document
     doc_index_dir.mkdir(parents=True, exist_ok=True) #ensure the directory exists
-    chunks_path = doc_index_dir / "chunks.json" #path to save the chunks
-    with open(chunks_path, "w", encoding="utf-8") as f: #opens the file in write mode
-        json.dump(chunks, f, ensure_ascii=False, indent=2) #saves the chunks as json
+    chunks = ChunkColumns(
+        doc_id=doc_id,
+        chunk_ids=np.asarray(chunk_ids, dtype=np.int32),
+        page_numbers=np.asarray(page_nums, dtype=np.int32),
+        texts=text_chunks,
+    )
+    save_chunks(doc_index_dir, chunks) #saves chunks.parquet
 
     total_chunks = len(chunks)
-    avg_len = (sum(len(c["text"]) for c in chunks) / total_chunks) if total_chunks else 0
+    avg_len = (sum(len(t) for t in text_chunks) / total_chunks) if total_chunks else 0
 
     #printing chunk summary to console
-    print("doc_id:", doc_id)
-    print("bytes_saved:", bytes_saved) 
     print("total_chunks:", total_chunks)
     print("avg_chunk_length:", avg_len)
     if total_chunks:
-        sample = chunks[0].copy() #take a sample chunk
-        sample["text"] = sample["text"][:200]  # shorten for console
+        sample = { #take a sample chunk
+            "chunk_uid": chunks.chunk_uid(0),
+            "page_number": int(chunks.page_numbers[0]),
+            "text": text_chunks[0][:200],  # shorten for console
+        }
         print("sample_chunk:", sample)
 
+    return pages, chars_extracted, preview, total_chunks
+
+
+@app.post("/upload")
+async def upload_pdf(file: UploadFile = File(...)):
+    #if the file has no name
+    if not file.filename:
+        raise HTTPException(status_code=400, detail ="Missing filename")
+    #if the file type is not a pdf
+    if file.content_type not in ("application/pdf", "application/x-pdf"):
+        raise HTTPException(status_code=415, detail=f"Unsupported content type: {file.content_type}")
+    
+    #unique identifier for the document
+    doc_id = str(uuid.uuid4())
+    save_path = UPLOAD_DIR / f"{doc_id}.pdf" #path to save the file
+
+    #writes the file to disk (off the event loop, since the copy is blocking)
+    bytes_saved = await run_in_threadpool(_save_upload, file.file, save_path) #how many bytes have been saved
+    print("doc_id:", doc_id)
+    print("bytes_saved:", bytes_saved) 
+
+    #extracts, chunks and saves off the event loop so concurrent uploads overlap
+    pages, chars_extracted, preview, total_chunks = await run_in_threadpool(_process_pdf, save_path, doc_id)
+
     return {
         "doc_id": doc_id,
         "pages": pages,
         "chars_extracted": chars_extracted,
         "preview": preview,
-        "total_chunks": len(chunks),
+        "total_chunks": total_chunks,
         "index_built": False  
     }
 
 
-# This reads chunks.json, embeds the chunks, builds FAISS, and saves index.faiss (+ meta.json).
+# This reads the saved chunks, embeds them, and saves vectors.npy (small docs) or a FAISS index.faiss (+ meta.npy).
 @app.post("/index/{doc_id}")
 def index_doc(doc_id: str):
 
     try:
-        stats = build_index_for_doc(doc_id, write_meta=True)
+        stats = build_index_for_doc(doc_id)
+        doc_registry.invalidate(doc_id) #a rebuilt index must not be served from the stale cached copy
         return {
             "doc_id": doc_id,
             "total_chunks_loaded": stats.total_chunks_loaded,
@@ -163,10 +215,11 @@ class SearchRequest(BaseModel):
 
 # This is the Phase 3 deliverable: returns top-k chunks + similarity scores.
 @app.post("/search")
-def search(req: SearchRequest):
+async def search(req: SearchRequest):
 
     try:
-        return search_doc(req.doc_id, req.query, req.k)
+        # concurrent searches are batched into one embedding call
+        return await query_batcher.search(req.doc_id, req.query, req.k)
     except FileNotFoundError as e:
         raise HTTPException(status_code=404, detail=str(e))
     except ValueError as e:
@@ -197,11 +250,11 @@ class AskResponse(BaseModel):
 
 
 @app.post("/ask", response_model=AskResponse)
-def ask(req: AskRequest):
+async def ask(req: AskRequest):
 
     try:
-        # 1) retrieve
-        retrieved = search_doc(req.doc_id, req.question, req.k)
+        # 1) retrieve (batched with other concurrent queries, off the event loop)
+        retrieved = await query_batcher.search(req.doc_id, req.question, req.k)
         results = retrieved.get("results", [])
 
         if not results:
@@ -212,7 +265,7 @@ def ask(req: AskRequest):
             )
 
         # 2) LLM answer grounded in retrieved chunks
-        llm_out = answer_with_citations(req.question, results)
+        llm_out = await answer_with_citations(req.question, results)
 
         # 3) return
         return AskResponse(
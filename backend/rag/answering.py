@@ -16,16 +16,40 @@ client = genai.Client(api_key=os.getenv("GEMINI_API_KEY"))
 
 MODEL = os.getenv("GEMINI_MODEL", "gemini-2.5-flash")
 
+# Code-fence patterns stripped from Gemini output (compiled once at import)
+_RE_JSON_FENCE = re.compile(r"^```json\s*")
+_RE_FENCE = re.compile(r"^```\s*")
+_RE_TAIL_FENCE = re.compile(r"\s*```$")
+
+# Flattens line breaks in source text to spaces in a single pass
+_NL_TABLE = str.maketrans({"\n": " ", "\r": " "})
+
+# Static part of the answering prompt (built once; question and sources are appended per call)
+_PROMPT_HEADER = """You are answering a question using ONLY the provided sources.
+
+Rules:
+- Use ONLY the sources below. Do not use outside knowledge.
+- If the answer is not contained in the sources, return exactly:
+  "I don't know based on the provided sources."
+- Cite sources using chunk IDs like [docid_00012] where the ID matches the bracketed IDs in Sources.
+- Return ONLY JSON. No markdown. No backticks. No extra text.
+
+JSON format:
+{
+  "answer": "string",
+  "citations": [
+    {"chunk_id": "string", "page": 1, "snippet": "string"}
+  ]
+}
+"""
+
 
 def _build_sources(results: List[Dict[str, Any]]) -> str:
     """Format retrieval results into a sources block with chunk_id + page."""
-    lines: List[str] = []
-    for r in results:
-        chunk_id = r.get("chunk_uid")
-        page = r.get("page_number")
-        text = (r.get("text") or "").strip().replace("\n", " ")
-        lines.append(f"[{chunk_id}] (page {page}) {text}")
-    return "\n".join(lines)
+    return "\n".join([
+        f"[{r.get('chunk_uid')}] (page {r.get('page_number')}) {(r.get('text') or '').translate(_NL_TABLE).strip()}"
+        for r in results
+    ])
 
 
 def _get_text(resp: Any) -> str:
@@ -60,9 +84,9 @@ def _extract_json(text: str) -> Dict[str, Any]:
     t = text.strip()
 
     # Remove fenced code blocks if present
-    t = re.sub(r"^```json\s*", "", t)
-    t = re.sub(r"^```\s*", "", t)
-    t = re.sub(r"\s*```$", "", t).strip()
+    t = _RE_JSON_FENCE.sub("", t)
+    t = _RE_FENCE.sub("", t)
+    t = _RE_TAIL_FENCE.sub("", t).strip()
 
     # Extract the first JSON object substring
     start = t.find("{")
@@ -74,7 +98,7 @@ def _extract_json(text: str) -> Dict[str, Any]:
     return json.loads(candidate)
 
 
-def answer_with_citations(question: str, results: List[Dict[str, Any]]) -> Dict[str, Any]:
+async def answer_with_citations(question: str, results: List[Dict[str, Any]]) -> Dict[str, Any]:
     """
     Inputs:
       question: user question
@@ -99,34 +123,15 @@ def answer_with_citations(question: str, results: List[Dict[str, Any]]) -> Dict[
 
     allowed = {r["chunk_uid"] for r in results if "chunk_uid" in r}
 
-    prompt = f"""
-You are answering a question using ONLY the provided sources.
-
-Rules:
-- Use ONLY the sources below. Do not use outside knowledge.
-- If the answer is not contained in the sources, return exactly:
-  "I don't know based on the provided sources."
-- Cite sources using chunk IDs like [docid_00012] where the ID matches the bracketed IDs in Sources.
-- Return ONLY JSON. No markdown. No backticks. No extra text.
-
-JSON format:
-{{
-  "answer": "string",
-  "citations": [
-    {{"chunk_id": "string", "page": 1, "snippet": "string"}}
-  ]
-}}
-
-Question:
-{question}
-
-Sources:
-{_build_sources(results)}
-""".strip()
+    prompt = f"{_PROMPT_HEADER}\nQuestion:\n{question}\n\nSources:\n{_build_sources(results)}"
 
-    resp = client.models.generate_content(model=MODEL, contents=prompt)
+    # Stream the response so text is buffered as it arrives; parse once at the end
+    parts: List[str] = []
+    stream = await client.aio.models.generate_content_stream(model=MODEL, contents=prompt)
+    async for chunk in stream:
+        parts.append(_get_text(chunk))
 
-    text = _get_text(resp)
+    text = "".join(parts)
 
 
 
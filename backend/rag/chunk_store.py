@@ -0,0 +1,74 @@
+# chunk_store.py - columnar storage for a document's chunks (one array per field instead of one dict per chunk)
+from __future__ import annotations
+
+from dataclasses import dataclass
+import json
+from pathlib import Path
+from typing import List
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# all chunks of one document as parallel columns, row i of every column belongs to chunk i
+@dataclass
+class ChunkColumns:
+    doc_id: str
+    chunk_ids: np.ndarray #int32, one per chunk
+    page_numbers: np.ndarray #int32, one per chunk
+    texts: List[str]
+
+    def __len__(self) -> int:
+        return len(self.texts)
+
+    #unique identifier for the chunk stored in a given row
+    def chunk_uid(self, row: int) -> str:
+        return f"{self.doc_id}_{int(self.chunk_ids[row]):05d}"
+
+#writes the chunk columns to chunks.parquet (zstd-compressed)
+def save_chunks(doc_dir: Path, cols: ChunkColumns) -> None:
+    n = len(cols)
+    table = pa.table(
+        {
+            "chunk_id": pa.array(cols.chunk_ids, type=pa.int32()),
+            "chunk_uid": pa.array([cols.chunk_uid(i) for i in range(n)], type=pa.string()),
+            "page_number": pa.array(cols.page_numbers, type=pa.int32()),
+            "text": pa.array(cols.texts, type=pa.string()),
+            "doc_id": pa.array([cols.doc_id] * n, type=pa.string()),
+        }
+    )
+    pq.write_table(table, doc_dir / "chunks.parquet", compression="zstd")
+
+#reads a chunks.json written by older uploads (a JSON list of chunk dicts) into columns
+def _load_legacy_chunks(doc_dir: Path) -> ChunkColumns:
+    with open(doc_dir / "chunks.json", "r", encoding="utf-8") as f:
+        chunks = json.load(f)
+    if not isinstance(chunks, list):
+        raise ValueError("chunks.json must contain a JSON list.")
+    return ChunkColumns(
+        doc_id=doc_dir.name,
+        chunk_ids=np.asarray([c.get("chunk_id") for c in chunks], dtype=np.int32),
+        page_numbers=np.asarray([c.get("page_number") for c in chunks], dtype=np.int32),
+        texts=[c.get("text") or "" for c in chunks],
+    )
+
+#reads the columns written by save_chunks, the doc_id is the name of the document directory
+#only the columns ChunkColumns needs are read (chunk_uid and doc_id are derivable)
+#documents uploaded before the parquet format only have chunks.json; it is converted (and saved as parquet) on first load
+def load_chunks(doc_dir: Path) -> ChunkColumns:
+    doc_id = doc_dir.name
+    chunks_path = doc_dir / "chunks.parquet"
+    if not chunks_path.exists():
+        if (doc_dir / "chunks.json").exists():
+            cols = _load_legacy_chunks(doc_dir)
+            save_chunks(doc_dir, cols)
+            return cols
+        raise FileNotFoundError(f"chunks.parquet not found for doc_id={doc_id}. Re-upload the document.")
+
+    table = pq.read_table(chunks_path, columns=["chunk_id", "page_number", "text"])
+    return ChunkColumns(
+        doc_id=doc_id,
+        chunk_ids=table.column("chunk_id").to_numpy(),
+        page_numbers=table.column("page_number").to_numpy(),
+        texts=table.column("text").to_pylist(),
+    )
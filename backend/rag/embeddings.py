@@ -1,38 +1,46 @@
 #embeddings.py - turns the chunks into vectors to perform vector search
 from __future__ import annotations # helps with forward references in type hints
 
+import os
+
 import numpy as np #handles vector math
+import torch #used to pick the device the model runs on
 from sentence_transformers import SentenceTransformer #the model that creates the embeddings
 
 _MODEL_NAME = "all-MiniLM-L6-v2" #type of model being used
+_BATCH_SIZE = 64 #number of texts sent through the model per forward pass
 _model: SentenceTransformer | None = None #initially none then becomes the loaded model
 
 #ensures the model is loaded
+#on a GPU the model runs in fp16, on CPU it stays fp32 and uses every core
 def _get_model() -> SentenceTransformer:
     global _model
     if _model is None:
-        _model = SentenceTransformer(_MODEL_NAME)
+        if torch.cuda.is_available():
+            _model = SentenceTransformer(_MODEL_NAME, device="cuda")
+            _model.half()
+        else:
+            torch.set_num_threads(os.cpu_count() or 1)
+            _model = SentenceTransformer(_MODEL_NAME, device="cpu")
     return _model
 
-#normalizes the vectors to all be the same length, only caring about the direction of each vector
-#need normalization for cosine similarity search so search results are accurate
-#mat is a numpy array where each row is a vector
-def _l2_normalize(mat: np.ndarray, eps: float = 1e-12) -> np.ndarray:
-    norms = np.linalg.norm(mat, axis=1, keepdims=True) #calculates the length of each vector
-    return mat / np.maximum(norms, eps) #divides each vector by its length to make it length 1
-
 #creates the embeddings for a list of texts(our chunks)
+#normalization happens inside encode so there is no second pass over the matrix
+#need normalization for cosine similarity search so search results are accurate
 def embed_texts(texts: list[str], normalize: bool = True) -> np.ndarray:
     if not texts:
         return np.zeros((0, 0), dtype=np.float32) #return empty matrix if no texts
 
     model = _get_model()
-    emb = model.encode(texts, convert_to_numpy=True, show_progress_bar=False) #creates the vectors for each text
-
-    emb = np.asarray(emb, dtype=np.float32)   # ensure float32 for FAISS
-
-    if normalize:
-        emb = _l2_normalize(emb) #normalizes the vectors
+    emb = model.encode(
+        texts,
+        batch_size=_BATCH_SIZE,
+        convert_to_numpy=True,
+        normalize_embeddings=normalize,
+        show_progress_bar=False,
+    ) #creates the vectors for each text
+
+    emb = np.asarray(emb, dtype=np.float32)   # ensure float32 for FAISS (fp16 on GPU)
 
     return emb
 
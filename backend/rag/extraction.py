@@ -0,0 +1,75 @@
+# extraction.py - pulls the text out of every page of a PDF
+# kept free of heavy imports because worker processes import this module on startup
+from __future__ import annotations
+
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+from typing import List
+
+import pymupdf
+
+# measured on dense text pages: ~1.4 ms to extract a page inline, ~4 ms overhead per task on a warm pool
+# (open + IPC), ~160 ms to spawn a worker (paid once per process, not per upload)
+# break-even is ~10 dense pages and higher for sparse ones, so only clearly large pdfs use the pool
+PARALLEL_MIN_PAGES = 64
+EXTRACT_WORKERS = min(4, os.cpu_count() or 1) #fixed size, shared by every upload
+
+_pool: ProcessPoolExecutor | None = None #created on first large pdf, reused after that
+_pool_lock = threading.Lock() #uploads run on several worker threads
+_mupdf_lock = threading.Lock() #PyMuPDF is not thread-safe, so in-process calls from upload threads take turns
+
+#returns the shared worker pool, creating it on first use
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # spawn, not fork: the server process is multi-threaded
+            _pool = ProcessPoolExecutor(
+                max_workers=EXTRACT_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _pool
+
+#shuts the shared pool down (called when the app stops)
+def shutdown_pool() -> None:
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(cancel_futures=True)
+            _pool = None
+
+#extracts pages [start, stop) in a worker process, opening the pdf once per task
+def _extract_range(path: str, start: int, stop: int) -> List[str]:
+    with pymupdf.open(path) as doc:
+        return [doc[i].get_text("text") or "" for i in range(start, stop)]
+
+#returns the text of each page in page order ("" for pages with no text)
+#pages are independent, so large pdfs are split into page ranges across the shared process pool
+#PyMuPDF is not thread-safe: this runs on several upload threads at once, so every in-process call
+#(page count probe and small-pdf extraction) holds _mupdf_lock; pool workers are separate processes
+def extract_page_texts(path: Path) -> List[str]:
+    global _pool
+    with _mupdf_lock:
+        with pymupdf.open(path) as doc:
+            pages = doc.page_count
+            if pages < PARALLEL_MIN_PAGES or EXTRACT_WORKERS < 2:
+                return [page.get_text("text") or "" for page in doc]
+
+    step = -(-pages // EXTRACT_WORKERS) #one contiguous range per worker
+    pool = _get_pool()
+    try:
+        futures = [
+            pool.submit(_extract_range, str(path), start, min(start + step, pages))
+            for start in range(0, pages, step)
+        ]
+        return [text for fut in futures for text in fut.result()]
+    except BrokenProcessPool:
+        # a worker died; drop the pool so the next upload starts a fresh one
+        with _pool_lock:
+            if _pool is pool:
+                _pool = None
+        raise
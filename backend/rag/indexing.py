@@ -4,15 +4,17 @@ from __future__ import annotations
 
 from dataclasses import dataclass
 from pathlib import Path
-import json
-from typing import Any, Dict, List, Tuple
+import os
+from typing import List, Tuple
 
 import numpy as np
 import faiss 
 
+from .chunk_store import ChunkColumns, load_chunks
 from .embeddings import embed_texts #import the embedding function from embeddings.py
 
 INDEX_DIR = Path("data/index")
+EXACT_SEARCH_MAX_VECTORS = 2048 #below this, only fp16 vectors.npy is saved (no FAISS index) and retrieval searches it with a plain matmul
 
 # statistics about the index build process, @dataclass just means that it's a data container
 @dataclass
@@ -22,54 +24,41 @@ class IndexBuildStats:
     total_chunks_indexed: int
     embedding_dim: int #dimension of the embedding vectors(number of items in each vector)
 
-#takes the document id and loads the chunks from chunks.json
-def _load_chunks(doc_id: str) -> List[Dict[str, Any]]:
-    doc_dir = INDEX_DIR / doc_id
-    chunks_path = doc_dir / "chunks.json"
-    if not chunks_path.exists():
-        raise FileNotFoundError(f"chunks.json not found for doc_id={doc_id}")
-
-    with open(chunks_path, "r", encoding="utf-8") as f:
-        chunks = json.load(f) #takes the json file and turns it into a python object
-
-    if not isinstance(chunks, list):
-        raise ValueError("chunks.json must contain a JSON list.")
-    return chunks
-
-#selects the texts and metadata from the chunks for embedding and indexing
+#selects the texts for embedding and indexing, plus the chunk row each FAISS row maps to
 def _select_texts_and_meta(
-    chunks: List[Dict[str, Any]],
+    chunks: ChunkColumns,
     min_chars: int = 30,
-) -> Tuple[List[str], List[Dict[str, Any]]]:
+) -> Tuple[List[str], np.ndarray]:
     
-    texts: List[str] = [] #the actual text chunks to be embedded
-    meta: List[Dict[str, Any]] = [] #references to the chunks
-
-    for c in chunks:
-        text = (c.get("text") or "")
-        if len(text.strip()) < min_chars: #skip chunks that are too short
-            continue
-
-        texts.append(text) #add the text to the list of texts to embed
-        #add metadata for this chunk
-        meta.append(
-            {
-                "chunk_uid": c.get("chunk_uid"),
-                "chunk_id": c.get("chunk_id"),
-                "page_number": c.get("page_number"),
-            }
-        )
+    #rows of chunks long enough to be worth a vector
+    rows = [i for i, text in enumerate(chunks.texts) if len(text.strip()) >= min_chars]
+    texts = [chunks.texts[i] for i in rows] #the actual text chunks to be embedded
+    meta = np.asarray(rows, dtype=np.int32) #meta[faiss_row] == chunk row
 
     return texts, meta
 
+#builds the FAISS index over the (already normalized) vectors, so inner product == cosine
+#only used for documents with at least EXACT_SEARCH_MAX_VECTORS vectors: an IVF index with int8 scalar
+#quantization (4x smaller than fp32, less memory traffic per search)
+def _build_index(vectors: np.ndarray) -> faiss.Index:
+    n, dim = vectors.shape
+    nlist = min(100, n // 39) #faiss wants ~39 training points per list
+    quantizer = faiss.IndexFlatIP(dim)
+    index = faiss.IndexIVFScalarQuantizer(
+        quantizer, dim, nlist, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT
+    )
+    index.train(vectors)
+    index.add(vectors)
+    return index
+
 #builds the FAISS index for a document given its id
-def build_index_for_doc(doc_id: str, write_meta: bool = True) -> IndexBuildStats:
+def build_index_for_doc(doc_id: str) -> IndexBuildStats:
 
     doc_dir = INDEX_DIR / doc_id
     if not doc_dir.exists():
         raise FileNotFoundError(f"doc directory not found: {doc_dir}")
 
-    chunks = _load_chunks(doc_id)
+    chunks = load_chunks(doc_dir)
     texts, meta = _select_texts_and_meta(chunks)
 
     # Creates the embeddings for the selected texts
@@ -82,23 +71,31 @@ def build_index_for_doc(doc_id: str, write_meta: bool = True) -> IndexBuildStats
 
     n, dim = vectors.shape #n is number of vectors, dim is dimension of each vector
 
-    # Build exact search index (flat, inner product)
-    index = faiss.IndexFlatIP(dim)
-    index.add(vectors)
-
-    # Save index
     index_path = doc_dir / "index.faiss"
-    faiss.write_index(index, str(index_path))
-
-    # Save meta mapping (recommended)
-    if write_meta:
-        meta_path = doc_dir / "meta.json"
-        with open(meta_path, "w", encoding="utf-8") as f:
-            json.dump(meta, f, ensure_ascii=False, indent=2)
+    vectors_path = doc_dir / "vectors.npy"
+    if n < EXACT_SEARCH_MAX_VECTORS:
+        # Small document: save the vectors as fp16 (2x smaller than fp32) and skip FAISS entirely
+        # written to a temp file then swapped in, so a concurrent reader never sees a partial file
+        tmp_vectors_path = doc_dir / "vectors.tmp.npy"
+        np.save(tmp_vectors_path, vectors.astype(np.float16))
+        os.replace(tmp_vectors_path, vectors_path)
+        index_path.unlink(missing_ok=True) #drop an index left by an earlier build
+    else:
+        # Large document: build and save the search index (inner product)
+        # written to a temp file then swapped in, so a cached memory-mapped copy of the old index is never truncated
+        index = _build_index(vectors)
+        tmp_path = doc_dir / "index.faiss.tmp"
+        faiss.write_index(index, str(tmp_path))
+        os.replace(tmp_path, index_path)
+        vectors_path.unlink(missing_ok=True) #drop vectors left by an earlier build
+
+    # Save meta mapping (always written, retrieval needs it to map search rows to chunks)
+    meta_path = doc_dir / "meta.npy"
+    np.save(meta_path, meta)
 
     return IndexBuildStats(
         doc_id=doc_id,
         total_chunks_loaded=len(chunks),
-        total_chunks_indexed=index.ntotal,
+        total_chunks_indexed=n,
         embedding_dim=dim,
     )
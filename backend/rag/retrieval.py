@@ -1,99 +1,149 @@
 # retrieval.py - performs vector search on the indexed documents
 from __future__ import annotations
 
+import asyncio
+from collections import OrderedDict
 from pathlib import Path
-import json
+import threading
 from typing import Any, Dict, List, Tuple
 
 import numpy as np
 import faiss  # type: ignore
 
-from .embeddings import embed_query
+from .chunk_store import ChunkColumns, load_chunks
+from .embeddings import embed_query, embed_texts
 
 INDEX_DIR = Path("data/index")
+NPROBE = 10 #number of IVF lists scanned per query
+
+# loads the FAISS index for a given document id, read-only
+# IO_FLAG_MMAP only memory-maps IVF inverted lists (what indexing builds); IO_FLAG_MMAP_IFC also maps the codes of
+# flat-code indexes (e.g. IndexScalarQuantizer files from older builds), so the vector data is never copied into RAM
+_READ_FLAGS = faiss.IO_FLAG_MMAP | getattr(faiss, "IO_FLAG_MMAP_IFC", 0) | faiss.IO_FLAG_READ_ONLY
 
-# loads the FAISS index for a given document id
 def _load_index(doc_id: str) -> faiss.Index:
     doc_dir = INDEX_DIR / doc_id
     index_path = doc_dir / "index.faiss"
     if not index_path.exists():
         raise FileNotFoundError(f"index.faiss not found for doc_id={doc_id}. Build the index first.")
-    return faiss.read_index(str(index_path))
+    index = faiss.read_index(str(index_path), _READ_FLAGS)
+    if isinstance(index, faiss.IndexIVF):
+        index.nprobe = NPROBE
+    return index
 
-# loads the chunks for a given document id
-def _load_chunks(doc_id: str) -> List[Dict[str, Any]]:
-    doc_dir = INDEX_DIR / doc_id
-    chunks_path = doc_dir / "chunks.json"
-    if not chunks_path.exists():
-        raise FileNotFoundError(f"chunks.json not found for doc_id={doc_id}")
-    with open(chunks_path, "r", encoding="utf-8") as f:
-        chunks = json.load(f)
-    if not isinstance(chunks, list):
-        raise ValueError("chunks.json must contain a JSON list.")
-    return chunks
-
-# loads the meta information for a given document id, if it exists
-def _load_meta_if_exists(doc_id: str) -> List[Dict[str, Any]] | None:
+# loads the meta (FAISS row -> chunk row) and the chunk columns for a given document id
+def _load_doc_chunks(doc_id: str) -> Tuple[np.ndarray, ChunkColumns]:
     doc_dir = INDEX_DIR / doc_id
-    meta_path = doc_dir / "meta.json"
+    meta_path = doc_dir / "meta.npy"
     if not meta_path.exists():
+        raise FileNotFoundError(f"meta.npy not found for doc_id={doc_id}. Build the index first.")
+    meta = np.load(meta_path)
+    if meta.ndim != 1:
+        raise ValueError("meta.npy must contain a 1D array of chunk rows.")
+    return meta, load_chunks(doc_dir)
+
+# loads the raw (normalized) vectors for a given document id, if indexing saved them
+# only small documents have them (stored fp16, converted to fp32 once here); None means search goes through FAISS
+def _load_vectors(doc_id: str) -> np.ndarray | None:
+    vectors_path = INDEX_DIR / doc_id / "vectors.npy"
+    if not vectors_path.exists():
         return None
-    with open(meta_path, "r", encoding="utf-8") as f:
-        meta = json.load(f)
-    if not isinstance(meta, list):
-        raise ValueError("meta.json must contain a JSON list.")
-    return meta
-
-# builds a lookup dictionary from chunk_uid to chunk object
-def _build_chunk_lookup(chunks: List[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
-    lookup: Dict[str, Dict[str, Any]] = {}
-    for c in chunks:
-        uid = c.get("chunk_uid")
-        if uid:
-            lookup[str(uid)] = c
-    return lookup
-
-#embeds the user query, searches FAISS for the top-k similar chnk vectors, and maps those FAISS results back to the original chunks
-def search_doc(doc_id: str, query: str, k: int = 5) -> Dict[str, Any]:
-    if k <= 0:
-        raise ValueError("k must be > 0")
-
-    index = _load_index(doc_id) #loads the FAISS index
-    chunks = _load_chunks(doc_id) #loads the chunks
-    meta = _load_meta_if_exists(doc_id) #loads the meta if it exists
-
-    qvec = embed_query(query, normalize=True)  # embeds the query (1, dim)
-
-    # FAISS returns:
+    return np.load(vectors_path).astype(np.float32)
+
+# exact top-k by inner product with a single matmul, for small documents where FAISS call overhead dominates
+# returns (scores, ids) shaped (1, k) like index.search
+def _search_vectors(vectors: np.ndarray, qvec: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    scores = vectors @ qvec[0] #(n,) similarity of every chunk to the query
+    k = min(k, scores.shape[0])
+    top = np.argpartition(scores, -k)[-k:] #unordered top-k
+    top = top[np.argsort(-scores[top])] #highest score first
+    return scores[top][None, :], top[None, :]
+
+# loads everything a query needs for a document: (faiss index, meta, chunk columns, vectors)
+# small documents have vectors and no index, large documents have an index and no vectors
+def _load_doc(doc_id: str) -> Tuple[faiss.Index | None, np.ndarray, ChunkColumns, np.ndarray | None]:
+    vectors = _load_vectors(doc_id)
+    index = _load_index(doc_id) if vectors is None else None
+    meta, chunks = _load_doc_chunks(doc_id)
+    return index, meta, chunks, vectors
+
+# process-wide in-memory cache of each document's search data (see _load_doc)
+# entries load lazily on first use, so only a cold query pays for file I/O and parsing
+# the least recently used document is dropped once max_docs are held
+class DocRegistry:
+    def __init__(self, max_docs: int = 128) -> None:
+        self.max_docs = max_docs
+        self._cache: OrderedDict[str, Tuple[faiss.Index | None, np.ndarray, ChunkColumns, np.ndarray | None]] = OrderedDict()
+        self._lock = threading.Lock() #guards the cache only, never held during file I/O (get runs on one worker thread per search request)
+        self._loading: Dict[str, threading.Lock] = {} #per-doc locks so one document is only loaded once at a time
+        self._generation: Dict[str, int] = {} #bumped on invalidate so a load that raced a rebuild is not cached
+
+    def get(self, doc_id: str) -> Tuple[faiss.Index | None, np.ndarray, ChunkColumns, np.ndarray | None]:
+        with self._lock:
+            entry = self._cache.get(doc_id)
+            if entry is not None:
+                self._cache.move_to_end(doc_id)
+                return entry
+            doc_lock = self._loading.setdefault(doc_id, threading.Lock())
+
+        # cold load: other documents stay servable while this one reads from disk
+        with doc_lock:
+            with self._lock:
+                entry = self._cache.get(doc_id) #another thread may have loaded it while we waited
+                if entry is not None:
+                    return entry
+                generation = self._generation.get(doc_id, 0)
+
+            entry = None
+            try:
+                entry = _load_doc(doc_id)
+            finally:
+                with self._lock:
+                    if entry is not None and self._generation.get(doc_id, 0) == generation:
+                        self._cache[doc_id] = entry
+                        if len(self._cache) > self.max_docs:
+                            self._cache.popitem(last=False)
+                    if self._loading.get(doc_id) is doc_lock:
+                        del self._loading[doc_id]
+            return entry
+
+    # drops a document so the next query re-reads it (call after its index is rebuilt)
+    def invalidate(self, doc_id: str) -> None:
+        with self._lock:
+            self._cache.pop(doc_id, None)
+            self._generation[doc_id] = self._generation.get(doc_id, 0) + 1
+
+doc_registry = DocRegistry()
+
+#searches a loaded document (an entry from doc_registry) for the top-k chunk vectors closest to an already-embedded
+#query (1, dim) and maps those rows back to their chunks, in memory only
+def _search_with_vector(
+    entry: Tuple[faiss.Index | None, np.ndarray, ChunkColumns, np.ndarray | None],
+    doc_id: str,
+    query: str,
+    qvec: np.ndarray,
+    k: int,
+) -> Dict[str, Any]:
+    index, meta, chunks, vectors = entry #FAISS index or raw vectors, row mapping, chunk columns
+
+    # Both return:
     # scores: shape (1, k), indices: shape (1, k)
-    scores, ids = index.search(qvec, k)
+    if vectors is not None:
+        scores, ids = _search_vectors(vectors, qvec, k) #small document: direct matmul
+    else:
+        scores, ids = index.search(qvec, k)
 
     scores_list = scores[0].tolist() #flatten to 1D list
     ids_list = ids[0].tolist() #flatten to 1D list
 
-    # Prepare mapping to full chunk objects
-    chunk_lookup = _build_chunk_lookup(chunks)
-
     results: List[Dict[str, Any]] = []
     for score, row in zip(scores_list, ids_list):
         # FAISS may return -1 if not enough vectors (rare with Flat, but still possible)
         if row == -1:
             continue
 
-        chunk_obj: Dict[str, Any] | None = None
-
-        if meta is not None:
-            # Use meta row -> chunk_uid
-            m = meta[row]
-            uid = m.get("chunk_uid")
-            if uid is not None:
-                chunk_obj = chunk_lookup.get(str(uid))
-        else:
-            # Fallback: assume FAISS rows align with chunks list order
-            if 0 <= row < len(chunks):
-                chunk_obj = chunks[row]
-
-        if chunk_obj is None:
+        chunk_row = int(meta[row]) if 0 <= row < len(meta) else -1
+        if not 0 <= chunk_row < len(chunks):
             # If mapping fails, still return the row+score for debugging
             results.append({"score": float(score), "row": int(row), "error": "Missing chunk mapping"})
             continue
@@ -101,11 +151,97 @@ def search_doc(doc_id: str, query: str, k: int = 5) -> Dict[str, Any]:
         results.append(
             {
                 "score": float(score),
-                "chunk_uid": chunk_obj.get("chunk_uid"),
-                "chunk_id": chunk_obj.get("chunk_id"),
-                "page_number": chunk_obj.get("page_number"),
-                "text": chunk_obj.get("text"),
+                "chunk_uid": chunks.chunk_uid(chunk_row),
+                "chunk_id": int(chunks.chunk_ids[chunk_row]),
+                "page_number": int(chunks.page_numbers[chunk_row]),
+                "text": chunks.texts[chunk_row],
             }
         )
 
     return {"doc_id": doc_id, "query": query, "k": k, "results": results}
+
+#embeds the user query, searches FAISS for the top-k similar chunk vectors, and maps those FAISS rows back to their chunks
+def search_doc(doc_id: str, query: str, k: int = 5) -> Dict[str, Any]:
+    if k <= 0:
+        raise ValueError("k must be > 0")
+
+    entry = doc_registry.get(doc_id) #fail fast on a missing index before paying for the embedding
+    qvec = embed_query(query, normalize=True)  # embeds the query (1, dim)
+    return _search_with_vector(entry, doc_id, query, qvec, k)
+
+#embeds a batch of queries in one forward pass, then runs each in-memory search (documents are already loaded)
+#returns one result dict (or the exception it raised) per queued query, in order
+def _search_batch(batch: List[Tuple[Any, str, str, int, asyncio.Future]]) -> List[Any]:
+    qvecs = embed_texts([query.strip() for _, _, query, _, _ in batch], normalize=True)
+    outcomes: List[Any] = []
+    for i, (entry, doc_id, query, k, _) in enumerate(batch):
+        try:
+            outcomes.append(_search_with_vector(entry, doc_id, query, qvecs[i : i + 1], k))
+        except Exception as e:
+            outcomes.append(e)
+    return outcomes
+
+# coalesces concurrent search requests so their queries share one embedding forward pass
+# the first queued query opens a short window, everything that arrives within it (up to max_batch) is embedded together
+# documents are loaded per request before queueing, so a cold load or a missing doc never holds up a batch
+class QueryBatcher:
+    def __init__(self, window_s: float = 0.01, max_batch: int = 64) -> None:
+        self.window_s = window_s #how long to wait for more queries after the first one
+        self.max_batch = max_batch
+        self._queue: asyncio.Queue | None = None
+        self._worker: asyncio.Task | None = None
+        self._running: set[asyncio.Task] = set() #batches in flight (kept referenced until done)
+
+    #async counterpart of search_doc, same result shape and errors
+    async def search(self, doc_id: str, query: str, k: int = 5) -> Dict[str, Any]:
+        if k <= 0:
+            raise ValueError("k must be > 0")
+        if not (query or "").strip():
+            raise ValueError("Query is empty.")
+
+        # loads (or fetches the cached) document in a worker thread; raises FileNotFoundError before any embedding
+        entry = await asyncio.to_thread(doc_registry.get, doc_id)
+
+        if self._worker is None or self._worker.done():
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.create_task(self._run())
+
+        fut = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((entry, doc_id, query, k, fut))
+        return await fut
+
+    #background task: collects a batch and hands it to its own task, so the next window opens while it runs
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.window_s
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            task = asyncio.create_task(self._process(batch))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    #runs one batch off the event loop and fans the results back out
+    async def _process(self, batch: List[Tuple[Any, str, str, int, asyncio.Future]]) -> None:
+        try:
+            outcomes = await asyncio.to_thread(_search_batch, batch)
+        except Exception as e: #embedding failed, so every query in the batch fails
+            outcomes = [e] * len(batch)
+
+        for (_, _, _, _, fut), outcome in zip(batch, outcomes):
+            if fut.done(): #caller went away
+                continue
+            if isinstance(outcome, Exception):
+                fut.set_exception(outcome)
+            else:
+                fut.set_result(outcome)
+
+query_batcher = QueryBatcher()